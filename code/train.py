@@ -1,28 +1,32 @@
+import math
 import os
 
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
-import torchvision.transforms as transforms
 from pytorch_lightning import LightningDataModule, LightningModule, Trainer
 from pytorch_lightning.callbacks.progress import TQDMProgressBar
-from torch.utils.data import DataLoader, random_split
+from torch.utils.data import DataLoader, TensorDataset, random_split
 from torchvision.datasets import MNIST
 import argparse
 from PIL import Image
-import time
-from torchvision.utils import save_image
 from pytorch_lightning.strategies import DDPStrategy
 from pytorch_lightning.plugins.environments.lightning_environment import LightningEnvironment
-from cleanfid import fid
+from torchmetrics.image.fid import FrechetInceptionDistance
 import os
-import glob
+
+# allow TF32 tensor cores for the remaining fp32 matmuls (Ampere and newer; no-op on V100)
+torch.set_float32_matmul_precision("high")
 
 PATH_DATASETS = os.environ.get("PATH_DATASETS", ".")
+MNIST_MEAN = 0.1307
+MNIST_STD = 0.3081
 BATCH_SIZE = 256 if torch.cuda.is_available() else 64
-NUM_WORKERS = int(os.cpu_count() / 2)
+# the datasets are pre-normalized in-memory tensors, so each rank loads batches in-process;
+# worker processes would only add IPC and shared-memory copies, whatever the world size
+NUM_WORKERS = 0
+LOG_IMAGES_EVERY_N_STEPS = 200
 
 
 class MNISTDataModule(LightningDataModule):
@@ -37,13 +41,6 @@ class MNISTDataModule(LightningDataModule):
         self.batch_size = batch_size
         self.num_workers = num_workers
 
-        self.transform = transforms.Compose(
-            [
-                transforms.ToTensor(),
-                transforms.Normalize((0.1307,), (0.3081,)),
-            ]
-        )
-
         self.dims = (1, 28, 28)
         self.num_classes = 10
 
@@ -52,39 +49,68 @@ class MNISTDataModule(LightningDataModule):
         MNIST(self.data_dir, train=True, download=True)
         MNIST(self.data_dir, train=False, download=True)
 
+    def _load(self, train):
+        # normalize the whole split once up front instead of per sample in every worker;
+        # images stay flattened to (N, 784) since both networks consume flat pixels
+        mnist = MNIST(self.data_dir, train=train)
+        data = mnist.data.flatten(1).float().div_(255)
+        data = (data - MNIST_MEAN) / MNIST_STD
+        return TensorDataset(data, mnist.targets)
+
     def setup(self, stage=None):
         # Assign train/val datasets for use in dataloaders
         if stage == "fit" or stage is None:
-            mnist_full = MNIST(self.data_dir, train=True, transform=self.transform)
+            mnist_full = self._load(train=True)
             self.mnist_train, self.mnist_val = random_split(mnist_full, [55000, 5000])
 
         # Assign test dataset for use in dataloader(s)
         if stage == "test" or stage is None:
-            self.mnist_test = MNIST(self.data_dir, train=False, transform=self.transform)
+            self.mnist_test = self._load(train=False)
 
-    def train_dataloader(self):
+    def _dataloader(self, dataset, shuffle=False):
+        # pinned host buffers let Lightning's non_blocking copy overlap with compute
+        kwargs = {}
+        if self.num_workers > 0:
+            kwargs.update(persistent_workers=True, prefetch_factor=4)
         return DataLoader(
-            self.mnist_train,
+            dataset,
             batch_size=self.batch_size,
+            shuffle=shuffle,
             num_workers=self.num_workers,
+            pin_memory=True,
+            **kwargs,
         )
 
+    def train_dataloader(self):
+        # Lightning swaps in a DistributedSampler and keeps the shuffle setting under DDP
+        return self._dataloader(self.mnist_train, shuffle=True)
+
     def val_dataloader(self):
-        return DataLoader(self.mnist_val, batch_size=self.batch_size, num_workers=self.num_workers)
+        return self._dataloader(self.mnist_val)
 
     def test_dataloader(self):
-        return DataLoader(self.mnist_test, batch_size=self.batch_size, num_workers=self.num_workers)
+        return self._dataloader(self.mnist_test)
     
 
+@torch.no_grad()
+def _fuse_linear_bn(linear, bn):
+    # fold an eval-mode BatchNorm1d into the weight and bias of the preceding Linear
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    fused = nn.Linear(linear.in_features, linear.out_features).to(linear.weight)
+    fused.weight.copy_(linear.weight * scale.unsqueeze(1))
+    fused.bias.copy_((linear.bias - bn.running_mean) * scale + bn.bias)
+    return fused
+
+
 class Generator(nn.Module):
     def __init__(self, latent_dim, img_shape):
         super().__init__()
-        self.img_shape = img_shape
 
         def block(in_feat, out_feat, normalize=True):
             layers = [nn.Linear(in_feat, out_feat)]
             if normalize:
-                layers.append(nn.BatchNorm1d(out_feat, 0.8))
+                # Keras momentum=0.8 keeps 80% of the running stats, which is momentum=0.2 here
+                layers.append(nn.BatchNorm1d(out_feat, momentum=0.2))
             layers.append(nn.LeakyReLU(0.2, inplace=True))
             return layers
 
@@ -93,30 +119,36 @@ class Generator(nn.Module):
             *block(128, 256),
             *block(256, 512),
             *block(512, 1024),
-            nn.Linear(1024, int(np.prod(img_shape))),
+            nn.Linear(1024, math.prod(img_shape)),
             nn.Tanh(),
         )
 
     def forward(self, z):
-        img = self.model(z)
-        img = img.view(img.size(0), *self.img_shape)
-        return img
+        return self.model(z)
+
+    def fuse_bn_eval(self):
+        # inference-only copy of the model with every BatchNorm folded into its Linear
+        layers = []
+        for layer in self.model:
+            if isinstance(layer, nn.BatchNorm1d):
+                layers[-1] = _fuse_linear_bn(layers[-1], layer)
+            else:
+                layers.append(layer)
+        return nn.Sequential(*layers)
 
 class Discriminator(nn.Module):
     def __init__(self, img_shape):
         super().__init__()
 
         self.model = nn.Sequential(
-            nn.Linear(int(np.prod(img_shape)), 512),
+            nn.Linear(math.prod(img_shape), 512),
             nn.LeakyReLU(0.2, inplace=True),
             nn.Linear(512, 256),
             nn.LeakyReLU(0.2, inplace=True),
             nn.Linear(256, 1),
-            nn.Sigmoid(),
         )
 
-    def forward(self, img):
-        img_flat = img.view(img.size(0), -1)
+    def forward(self, img_flat):
         validity = self.model(img_flat)
 
         return validity
@@ -139,10 +171,34 @@ class GAN(LightningModule):
 
         # networks
         data_shape = (channels, width, height)
+        self.img_shape = data_shape
         self.generator = Generator(latent_dim=self.hparams.latent_dim, img_shape=data_shape)
         self.discriminator = Discriminator(img_shape=data_shape)
+        if hasattr(torch, "compile"):
+            # compile only the forwards so the submodules (and checkpoint keys) stay unchanged;
+            # the partial last batch of an epoch costs one extra recompile. Matmuls stay on cuBLAS;
+            # Inductor fuses the BatchNorm/LeakyReLU/Tanh ops between them into Triton kernels
+            self.generator.forward = torch.compile(self.generator.forward, fullgraph=True)
+            self.discriminator.forward = torch.compile(self.discriminator.forward, fullgraph=True)
+
+        # label targets expanded per step; buffers follow the module onto its device
+        self.register_buffer("ones_buf", torch.ones(1, 1), persistent=False)
+        self.register_buffer("zeros_buf", torch.zeros(1, 1), persistent=False)
 
         self.validation_z = torch.randn(256, self.hparams.latent_dim)
+        self.fused_generator = None
+        # each rank updates its own shard; the Inception statistics are all-reduced once in compute().
+        # Bypass nn.Module registration so the Inception weights stay out of checkpoints, the
+        # model summary and the DDP reducer; on_validation_epoch_start moves it to the device.
+        object.__setattr__(
+            self,
+            "fid",
+            FrechetInceptionDistance(
+                feature=2048, normalize=True, sync_on_compute=True, reset_real_features=False
+            ),
+        )
+        # the validation split never changes, so its Inception statistics are gathered only once
+        self.fid_real_cached = False
 
         self.example_input_array = torch.zeros(2, self.hparams.latent_dim)
 
@@ -150,33 +206,37 @@ class GAN(LightningModule):
         return self.generator(z)
 
     def adversarial_loss(self, y_hat, y):
-        return F.binary_cross_entropy(y_hat, y)
+        # y_hat are discriminator logits; the fused loss stays stable under bf16 autocast
+        return F.binary_cross_entropy_with_logits(y_hat, y)
 
     def training_step(self, batch, batch_idx, optimizer_idx):
         imgs, _ = batch
 
         # sample noise
-        z = torch.randn(imgs.shape[0], self.hparams.latent_dim)
-        z = z.type_as(imgs)
+        z = torch.randn(imgs.size(0), self.hparams.latent_dim, device=imgs.device, dtype=imgs.dtype)
 
         # train generator
         if optimizer_idx == 0:
 
             # generate images
-            self.generated_imgs = self(z)
+            fake_imgs = self(z)
+            self.generated_imgs = fake_imgs
 
             # log sampled images
-            sample_imgs = self.generated_imgs[:6]
-            grid = torchvision.utils.make_grid(sample_imgs)
-            self.logger.experiment.add_image("generated_images", grid, 0)
+            if self.trainer.is_global_zero and self.global_step % LOG_IMAGES_EVERY_N_STEPS == 0:
+                # autocast leaves the samples in bf16/fp16, which the TensorBoard writer cannot encode
+                sample_imgs = self.generated_imgs[:6].detach().float().view(-1, *self.img_shape)
+                grid = torchvision.utils.make_grid(sample_imgs)
+                self.logger.experiment.add_image("generated_images", grid, self.global_step)
 
             # ground truth result (ie: all fake)
-            # put on GPU because we created this tensor inside training_loop
-            valid = torch.ones(imgs.size(0), 1)
-            valid = valid.type_as(imgs)
+            valid = self.ones_buf.expand(imgs.size(0), 1)
 
             # adversarial loss is binary cross-entropy
-            g_loss = self.adversarial_loss(self.discriminator(self(z)), valid)
+            # toggle_optimizer has frozen the discriminator, so no D gradients are computed here;
+            # no_sync() is deliberately not used since it only exists on the whole-module DDP
+            # wrapper and would skip the generator's all-reduce too
+            g_loss = self.adversarial_loss(self.discriminator(fake_imgs), valid)
             self.log("g_loss", g_loss, prog_bar=True)
             return g_loss
 
@@ -185,14 +245,12 @@ class GAN(LightningModule):
             # Measure discriminator's ability to classify real from generated samples
 
             # how well can it label as real?
-            valid = torch.ones(imgs.size(0), 1)
-            valid = valid.type_as(imgs)
+            valid = self.ones_buf.expand(imgs.size(0), 1)
 
             real_loss = self.adversarial_loss(self.discriminator(imgs), valid)
 
             # how well can it label as fake?
-            fake = torch.zeros(imgs.size(0), 1)
-            fake = fake.type_as(imgs)
+            fake = self.zeros_buf.expand(imgs.size(0), 1)
 
             fake_loss = self.adversarial_loss(self.discriminator(self(z).detach()), fake)
 
@@ -201,58 +259,42 @@ class GAN(LightningModule):
             self.log("d_loss", d_loss, prog_bar=True)
             return d_loss
         
+    def _fid_images(self, imgs):
+        # undo the MNIST normalization and expand to the 3-channel [0, 1] input Inception expects
+        imgs = imgs.view(-1, *self.img_shape).float()
+        imgs = (imgs * MNIST_STD + MNIST_MEAN).clamp(0, 1)
+        return imgs.repeat(1, 3, 1, 1)
+
+    def _update_fid(self, imgs, real):
+        # run Inception outside mixed precision so real and fake features are both fp32
+        with torch.autocast(self.device.type, enabled=False):
+            self.fid.update(self._fid_images(imgs), real=real)
+
+    def on_validation_epoch_start(self):
+        self.fid.to(self.device)
+        self.fused_generator = self.generator.fuse_bn_eval()
+
     def validation_step(self, batch, batch_idx):
-        print("inside valiation code")
+        if self.fid_real_cached or self.trainer.sanity_checking:
+            return
         imgs, _ = batch
-        z = self.validation_z.type_as(imgs)
-
-        # log sampled images'
-        sample_imgs = self(z)
-        #print(sample_imgs)
-        grid = torchvision.utils.make_grid(sample_imgs)
-        print("comparing between images of length {} and {}".format(len(imgs),len(sample_imgs)))
-        #print(grid)
-
-        gen_images_path = "/tmp/gen_files"
-        src_images_path = "/tmp/src_files"
-        if self.trainer.is_global_zero:
-            if not os.path.exists(gen_images_path):
-                os.mkdir(gen_images_path)
-            
-            if not os.path.exists(src_images_path):
-                os.mkdir(src_images_path)
-        
-        ddp.barrier()
-        for img in sample_imgs:
-            save_image(img, gen_images_path + "/gen_"+str(time.time()) +".jpeg")
-        for img1 in imgs:
-            save_image(img1, src_images_path + "/src_"+str(time.time()) +".jpeg")
-        
-        return {"gen_path":gen_images_path,"src_path":src_images_path}
-
-   
-    def validation_step_end(self,batch_parts):
-        print("inside validation step end, this should run in one process")
-        print("we will run FID Generator here")
-        if self.trainer.is_global_zero:
-            gen_images_path = batch_parts["gen_path"]
-            src_images_path = batch_parts["src_path"]
-
-            score = fid.compute_fid(gen_images_path, src_images_path)
-
-            print("FID Score for the training epoch {} is {}".format(self.epoch, score))
-            #delete all files after the FID has finished.
-            files = glob.glob(gen_images_path + "/*")
-            for f in files:
-                os.remove(f)
-            sr_files = glob.glob(src_images_path + "/*")
-            for f in sr_files:
-                os.remove(f)
-        ddp.barrier()
-        return
+        self._update_fid(imgs, real=True)
+
+    def on_validation_epoch_end(self):
+        if not self.trainer.sanity_checking:
+            # validation_z is fixed and the generator frozen for the epoch, so the samples are
+            # identical on every batch; push them through Inception once as a single batch
+            sample_imgs = self.fused_generator(self.validation_z.to(self.device))
+            self._update_fid(sample_imgs, real=False)
+
+            # compute() is a collective, so every rank has to call it
+            score = self.fid.compute()
+            self.log("fid", score, rank_zero_only=True)
+            # with reset_real_features=False this only clears the fake statistics
+            self.fid.reset()
+            self.fid_real_cached = True
+        self.fused_generator = None
 
-
-        
     def configure_optimizers(self):
         lr = self.hparams.lr
         b1 = self.hparams.b1
@@ -283,6 +325,8 @@ if __name__ == "__main__":
     num_gpus = int(os.environ["SM_NUM_GPUS"])
     num_nodes = int(world_size/num_gpus)
     print("world size:{} Number of GPUS:{} Number of nodes:{}".format(world_size,num_gpus,num_nodes))
+    # bf16 autocast needs Ampere or newer; V100 (ml.p3) falls back to fp16 mixed precision
+    precision = "bf16" if torch.cuda.is_bf16_supported() else 16
     ddp = DDPStrategy(cluster_environment=env, process_group_backend="nccl", accelerator="gpu")
     dm = MNISTDataModule()
     model = GAN(*dm.dims)
@@ -290,7 +334,9 @@ if __name__ == "__main__":
     devices=num_gpus,
     num_nodes=num_nodes,
     max_epochs=50,
+    precision=precision,
     strategy=ddp,
+    replace_sampler_ddp=True,
     callbacks=[TQDMProgressBar(refresh_rate=20)],
     )
     trainer.fit(model, dm)